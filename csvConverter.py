@@ -0,0 +1,49 @@
+import csv
+import os
+import sqlite3
+
+# --- Mesmo caminho do banco usado pelo script.py (dentro do container,
+# sobrescrevível via DB_DIR como lá) ---
+DB_VOLUME_PATH = os.environ.get("DB_DIR", "/app/db_data")
+DATABASE_FILENAME = "whatsapp_data_v3.db"
+DATABASE = os.path.join(DB_VOLUME_PATH, DATABASE_FILENAME)
+
+CSV_FILENAME = "resumo_conversas.csv"
+
+
+def export_conversation_summary(csv_file=CSV_FILENAME):
+    """Exporta um resumo das conversas (contador + contagens por status) para CSV."""
+    db = sqlite3.connect(DATABASE)
+    try:
+        cursor = db.cursor()
+        # Uma única query com agregação condicional: os contadores são todos
+        # derivados de conversations.status (a tabela 'counters' foi
+        # aposentada; 'novas' espelha as conversas abertas, como no /count).
+        cursor.execute('''
+            SELECT
+                SUM(CASE WHEN status = 'open' THEN 1 ELSE 0 END) AS open_c,
+                SUM(CASE WHEN status = 'closed' THEN 1 ELSE 0 END) AS closed_c
+            FROM conversations
+        ''')
+        row = cursor.fetchone()
+        open_conversation_count = row[0] or 0
+        closed_conversation_count = row[1] or 0
+        new_conversation_count = open_conversation_count
+        print(f"Resumo: novas={new_conversation_count}, abertas={open_conversation_count}, encerradas={closed_conversation_count}")
+
+        # writerows único (uma chamada no módulo C do csv) + buffer de 64 KiB:
+        # o arquivo sai num flush só no close.
+        with open(csv_file, 'w', newline='', encoding='utf-8', buffering=65536) as outfile:
+            csv.writer(outfile).writerows([
+                ('Metrica', 'Valor'),
+                ('Novas Conversas (Total)', new_conversation_count),
+                ('Conversas Abertas (Atual)', open_conversation_count),
+                ('Conversas Encerradas', closed_conversation_count),
+            ])
+        print(f"Resumo exportado para {csv_file}")
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    export_conversation_summary()
@@ -1,27 +1,49 @@
+import atexit
+import hashlib
+import hmac
 import os
+import queue
+import threading
 import time
 import sqlite3
-from flask import Flask, request, abort, Response, g, jsonify # Usar jsonify
+from collections import OrderedDict
+import csv
+import io
+from flask import Flask, request, abort, Response, stream_with_context
 from flask_cors import CORS # Para CORS
 from dotenv import load_dotenv
 import logging # Para logs
 from waitress import serve # Importar waitress
 
+try:
+    import orjson # Serializador JSON em Rust, ~5x mais rápido que a stdlib
+except ImportError:
+    orjson = None
+    import json
+
 # --- Configuração ---
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app) # Habilita CORS
 
+# Payloads do webhook da Meta são pequenos; limitar o corpo dá um teto
+# rígido ao custo do HMAC (linear nos bytes) e barra POSTs abusivos antes
+# de qualquer trabalho.
+_MAX_BODY_BYTES = 256 * 1024
+app.config['MAX_CONTENT_LENGTH'] = _MAX_BODY_BYTES
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 VERIFY_TOKEN = os.environ.get("WHATSAPP_VERIFY_TOKEN", "fallback_verify_token")
 APP_SECRET = os.environ.get("WHATSAPP_APP_SECRET")
 if not APP_SECRET:
     logging.warning("WHATSAPP_APP_SECRET não está definida no .env. A validação de assinatura falhará.")
+# Codifica o segredo uma vez no import; evita um encode por request no HMAC.
+_APP_SECRET_BYTES = APP_SECRET.encode('utf-8') if APP_SECRET else None
 
 # --- DEFINIÇÃO CORRETA DO CAMINHO DO BANCO DE DADOS E CONFIGURAÇÃO DO DOCKER ---
-DB_VOLUME_PATH = "/app/db_data" # Diretório DENTRO do container
+DB_VOLUME_PATH = os.environ.get("DB_DIR", "/app/db_data") # Diretório DENTRO do container (sobrescrevível via .env)
 DATABASE_FILENAME = "whatsapp_data_v3.db" # Nome do arquivo
 DATABASE = os.path.join(DB_VOLUME_PATH, DATABASE_FILENAME) # Caminho completo DENTRO do container
 
@@ -32,16 +54,62 @@ try:
 except OSError as e:
      logging.error(f"Erro ao criar diretório do banco de dados {DB_VOLUME_PATH}: {e}")
 
+# --- SQL (constantes de módulo) ---
+# Reutilizar o mesmo objeto str por statement faz o cache de prepared
+# statements do sqlite3 acertar por identidade e evita montar as strings
+# a cada request.
+
+_SQL_UPSERT_OPEN = '''
+    INSERT INTO conversations
+    (sender_id, status, creation_timestamp, closed_timestamp, contact_name)
+    VALUES (?, 'open', ?, NULL, ?)
+    ON CONFLICT(sender_id) DO UPDATE SET
+        status = 'open',
+        creation_timestamp = excluded.creation_timestamp,
+        closed_timestamp = NULL,
+        contact_name = COALESCE(excluded.contact_name, conversations.contact_name)
+    WHERE conversations.status = 'closed'
+'''
+_SQL_STATUS_LIST = "SELECT sender_id, status, creation_timestamp, closed_timestamp, contact_name FROM conversations ORDER BY creation_timestamp DESC"
+_SQL_SELECT_STATUS = "SELECT status FROM conversations WHERE sender_id = ?"
+_SQL_CLOSE_CONV = "UPDATE conversations SET status = 'closed', closed_timestamp = ? WHERE sender_id = ?"
+_SQL_COUNT_BY_STATUS = '''
+    SELECT
+        SUM(CASE WHEN status = 'open' THEN 1 ELSE 0 END) AS open_c,
+        SUM(CASE WHEN status = 'closed' THEN 1 ELSE 0 END) AS closed_c
+    FROM conversations
+'''
+
 # --- Funções do Banco de Dados ---
 
+# Conexões por thread: abrir/fechar o sqlite a cada request custa um
+# sqlite3_open + PRAGMAs por POST, o que domina a latência das queries
+# pequenas do webhook. Cada thread do worker mantém a sua conexão viva.
+_tls = threading.local()
+_all_connections = []
+_all_connections_lock = threading.Lock()
+
 def get_db():
-    db = getattr(g, '_database', None)
+    db = getattr(_tls, 'db', None)
     if db is None:
-        logging.info(f"Conectando ao banco de dados: {DATABASE}")
+        logging.info("Conectando ao banco de dados: %s", DATABASE)
         try:
-            db = g._database = sqlite3.connect(DATABASE, timeout=10)
+            # isolation_level=None: transações explícitas (BEGIN IMMEDIATE /
+            # commit), sem o auto-BEGIN que o sqlite3 injeta farejando o tipo
+            # de cada statement.
+            # cached_statements acima do default (128): todos os statements
+            # quentes ficam preparados entre requests.
+            db = sqlite3.connect(DATABASE, timeout=10, isolation_level=None, cached_statements=256)
             db.row_factory = sqlite3.Row
             db.execute("PRAGMA journal_mode=WAL;")
+            db.execute("PRAGMA synchronous=NORMAL;")
+            db.execute("PRAGMA temp_store=MEMORY;")
+            db.execute("PRAGMA wal_autocheckpoint=1000;")
+            db.execute("PRAGMA cache_size=-64000;")      # 64 MB de page cache
+            db.execute("PRAGMA mmap_size=268435456;")    # leituras via mmap (256 MB)
+            _tls.db = db
+            with _all_connections_lock:
+                _all_connections.append(db)
             logging.info("Conexão com DB estabelecida.")
         except sqlite3.Error as e:
             logging.error(f"Erro ao conectar ao banco de dados: {e}")
@@ -50,13 +118,24 @@ def get_db():
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
+    # A conexão fica viva na thread; aqui apenas desfazemos transações
+    # pendentes de requests que terminaram com erro.
+    db = getattr(_tls, 'db', None)
+    if db is not None and exception is not None:
         try:
-            db.close()
-            logging.info("Conexão com o banco de dados fechada.")
+            db.rollback()
         except sqlite3.Error as e:
-            logging.error(f"Erro ao fechar a conexão com o banco de dados: {e}")
+            logging.error(f"Erro ao desfazer transação pendente: {e}")
+
+@atexit.register
+def _close_all_connections():
+    with _all_connections_lock:
+        for db in _all_connections:
+            try:
+                db.close()
+            except sqlite3.Error:
+                pass
+        _all_connections.clear()
 
 def init_db():
     """Cria as tabelas do banco de dados com a nova estrutura (inclui contact_name)."""
@@ -64,36 +143,299 @@ def init_db():
     try:
         with app.app_context():
             db = get_db()
-            cursor = db.cursor()
-            logging.info("Criando tabela 'conversations' (se não existir)...")
-            # --- ALTERAÇÃO NO SCHEMA: Adiciona contact_name ---
-            cursor.execute('''
+            # Versão do schema no próprio arquivo (PRAGMA user_version):
+            # reinícios do container com o banco já migrado retornam aqui
+            # sem rodar DDL nem tocar o WAL.
+            if db.execute("PRAGMA user_version").fetchone()[0] == 3:
+                logging.info("Schema já na versão 3, init_db pulado.")
+                return
+            logging.info("Criando tabela 'conversations' e índices (se não existirem)...")
+            # Um executescript só, numa transação única: um parse e um fsync
+            # no lugar de um micro-commit por statement de DDL.
+            # Índices: consultas por status (COUNT em /count) e ordenação por
+            # creation_timestamp em /status sairiam como full scan sem eles;
+            # o composto cobre (status, creation_timestamp, sender_id) para
+            # consultas filtradas já ordenadas direto do índice.
+            # A antiga tabela 'counters' foi aposentada: os contadores são
+            # derivados de conversations.status sob demanda (ver /count), o
+            # que elimina 2-3 escritas por mensagem e o risco de dessincronia.
+            db.executescript('''
+                BEGIN;
                 CREATE TABLE IF NOT EXISTS conversations (
                     sender_id TEXT PRIMARY KEY,
                     status TEXT NOT NULL CHECK(status IN ('open', 'closed')),
                     creation_timestamp INTEGER NOT NULL,
                     closed_timestamp INTEGER,
                     contact_name TEXT -- Coluna para armazenar o nome do contato
-                )
+                );
+                CREATE INDEX IF NOT EXISTS idx_conv_status ON conversations(status);
+                CREATE INDEX IF NOT EXISTS idx_conv_creation ON conversations(creation_timestamp DESC);
+                CREATE INDEX IF NOT EXISTS idx_conv_status_creation ON conversations(status, creation_timestamp DESC, sender_id);
+                COMMIT;
+                -- Estatísticas para o planner escolher os índices certos.
+                ANALYZE;
+                -- Marca o schema como migrado para os próximos boots.
+                PRAGMA user_version = 3;
             ''')
-            logging.info("Criando tabela 'counters' (se não existir)...")
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS counters (
-                    counter_name TEXT PRIMARY KEY,
-                    value INTEGER NOT NULL
-                )
-            ''')
-            logging.info("Inserindo contadores iniciais (se não existirem)...")
-            cursor.execute("INSERT OR IGNORE INTO counters (counter_name, value) VALUES (?, ?)", ('new_conversation_count', 0))
-            cursor.execute("INSERT OR IGNORE INTO counters (counter_name, value) VALUES (?, ?)", ('open_conversation_count', 0))
-            cursor.execute("INSERT OR IGNORE INTO counters (counter_name, value) VALUES (?, ?)", ('closed_conversation_count', 0))
-            db.commit()
             logging.info("Banco de dados inicializado com sucesso (v3).")
     except sqlite3.Error as e:
         logging.error(f"Erro de SQLite durante init_db: {e}")
     except Exception as e:
         logging.error(f"Erro inesperado durante init_db: {e}")
 
+# --- Respostas JSON ---
+
+def _json_dumps(obj):
+    """Serializa para bytes via orjson (cai para a stdlib se orjson faltar)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def _json_response(obj, status=200):
+    """Monta a resposta JSON via orjson (bytes direto, sem o encoder lento
+    da stdlib que o jsonify usa)."""
+    return Response(_json_dumps(obj), status=status, mimetype='application/json')
+
+# --- Cache dos Contadores ---
+
+# Dashboards consultam /count com alta frequência (até 1x/s); segurar o
+# resultado por 1s em memória evita SELECTs repetidos. Qualquer caminho
+# de escrita invalida o cache.
+_counters_cache = {'t': 0.0, 'v': None}
+_counters_cache_lock = threading.Lock()
+_COUNTERS_CACHE_TTL = 1.0
+
+def _invalidate_counters_cache():
+    with _counters_cache_lock:
+        _counters_cache['t'] = 0.0
+
+# --- Validação de Assinatura ---
+
+# Memoização por (assinatura, sha256 do corpo): a Meta reenvia o mesmo
+# payload (mesma assinatura) em retries e o retry pula o recálculo do HMAC.
+# A chave guarda só 32 bytes do digest do corpo — nunca o corpo em si, que
+# a 4096 x 256 KiB pinaria até ~1 GiB de payloads na memória do processo.
+_signature_results = OrderedDict()
+_signature_results_lock = threading.Lock()
+_SIGNATURE_RESULTS_MAX = 4096
+
+def _signature_valid(signature_hash, request_body):
+    """Valida o HMAC-SHA256 do corpo (memoizada, sem reter o corpo)."""
+    key = (signature_hash, hashlib.sha256(request_body).digest())
+    with _signature_results_lock:
+        cached = _signature_results.get(key)
+        if cached is not None:
+            _signature_results.move_to_end(key)
+            return cached
+    # Compara os digests crus (32 bytes) em vez das strings hex (64 chars):
+    # metade do loop de comparação e sem a alocação do hexdigest.
+    try:
+        received = bytes.fromhex(signature_hash)
+    except ValueError:
+        logging.warning("Assinatura com hex inválido.")
+        return False
+    try:
+        # hmac.digest: one-shot direto na EVP do OpenSSL (com SHA-NI em CPUs
+        # capazes), sem instanciar o objeto HMAC do wrapper Python.
+        expected = hmac.digest(_APP_SECRET_BYTES, request_body, 'sha256')
+    except Exception as e:
+        logging.error(f"Erro HMAC: {e}")
+        return False
+    valid = hmac.compare_digest(expected, received)
+    with _signature_results_lock:
+        _signature_results[key] = valid
+        while len(_signature_results) > _SIGNATURE_RESULTS_MAX:
+            _signature_results.popitem(last=False)
+    return valid
+
+# Entregas recentes: retry da Meta (mesma assinatura) responde 200 na hora,
+# sem repetir parse/escritas no banco.
+_recent_deliveries = OrderedDict()
+_recent_deliveries_lock = threading.Lock()
+_RECENT_DELIVERIES_MAX = 4096
+
+def _is_duplicate_delivery(signature_hash):
+    """Informa se esta entrega já foi persistida (sem registrá-la aqui)."""
+    with _recent_deliveries_lock:
+        if signature_hash in _recent_deliveries:
+            _recent_deliveries.move_to_end(signature_hash)
+            return True
+        return False
+
+def _record_delivery(signature_hash):
+    """Registra a entrega como processada.
+
+    Chamado pelo gravador DEPOIS do commit do lote: se o registro fosse no
+    request, uma entrega perdida (fila cheia ou erro de DB no flush) ficaria
+    marcada como processada e o retry da Meta — a válvula de segurança dos
+    descartes — responderia 200 sem regravar nada.
+    """
+    with _recent_deliveries_lock:
+        _recent_deliveries[signature_hash] = time.time()
+        if len(_recent_deliveries) > _RECENT_DELIVERIES_MAX:
+            _recent_deliveries.popitem(last=False)
+
+# --- Gravador assíncrono ---
+
+# A Meta só precisa do 200 dentro da janela de retry (~20s); não há motivo
+# para a resposta HTTP esperar o fsync do WAL. O POST apenas enfileira as
+# tuplas extraídas e responde; uma thread dedicada drena a fila, acumula
+# até _WRITER_BATCH_MAX mensagens (ou o que chegar em _WRITER_FLUSH_SECS)
+# e grava tudo num executemany/commit por flush. Com uma única thread
+# escrevendo, o lock de escrita do SQLite deixa de ser disputado pelas
+# threads do waitress.
+# Fila limitada: sob inundação descartamos com log (a Meta reenvia) em vez
+# de crescer sem teto na memória.
+# Remetentes sabidamente abertos (LRU): para conversa já aberta o UPSERT
+# é um no-op (o WHERE barra o DO UPDATE), então rajadas do mesmo sender
+# nem precisam entrar na fila — um hash lookup no lugar da ida ao B+tree.
+# O gravador marca os senders após cada commit; /close tira do cache e
+# deixa uma lápide com o instante do fechamento: se o /close aterrissar
+# entre o commit do lote e o _mark_senders_open, a lápide (mais nova que
+# o início do lote) impede a re-marcação como aberto — sem ela o sender
+# ficaria preso no cache e a conversa nunca mais reabriria.
+_open_senders = OrderedDict()
+_closed_tombstones = OrderedDict()
+_open_senders_lock = threading.Lock()
+_OPEN_SENDERS_MAX = 4096
+
+def _sender_known_open(sender_id):
+    with _open_senders_lock:
+        if sender_id in _open_senders:
+            _open_senders.move_to_end(sender_id)
+            return True
+        return False
+
+def _mark_senders_open(sender_ids, batch_start):
+    with _open_senders_lock:
+        for sender_id in sender_ids:
+            closed_at = _closed_tombstones.get(sender_id)
+            if closed_at is not None and closed_at >= batch_start:
+                # Fechado depois que o lote começou: o estado do banco já é
+                # 'closed', não pode voltar para o cache de abertos.
+                continue
+            _open_senders[sender_id] = True
+            _open_senders.move_to_end(sender_id)
+        while len(_open_senders) > _OPEN_SENDERS_MAX:
+            _open_senders.popitem(last=False)
+
+def _forget_sender(sender_id):
+    with _open_senders_lock:
+        _open_senders.pop(sender_id, None)
+        _closed_tombstones[sender_id] = time.monotonic()
+        _closed_tombstones.move_to_end(sender_id)
+        while len(_closed_tombstones) > _OPEN_SENDERS_MAX:
+            _closed_tombstones.popitem(last=False)
+
+_write_queue = queue.Queue(maxsize=10000)
+# Tamanho do lote configurável pelo ambiente: o ponto ótimo depende do
+# disco e do volume de tráfego (lotes maiores amortizam mais o commit,
+# mas atrasam a visibilidade em /count e /status).
+_WRITER_BATCH_MAX = int(os.environ.get("WRITER_BATCH_SIZE", 100))
+_WRITER_FLUSH_SECS = 0.2
+
+def _writer_loop():
+    while True:
+        # Bloqueia até a primeira mensagem; depois junta o que chegar até
+        # encher o lote ou vencer o prazo do flush.
+        batch = [_write_queue.get()]
+        deadline = time.monotonic() + _WRITER_FLUSH_SECS
+        while len(batch) < _WRITER_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_write_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Cada item é (tupla, assinatura|None): a assinatura viaja na última
+        # tupla da entrega e só entra no dedupe depois do commit do lote.
+        rows = [item[0] for item in batch]
+        # Época do lote: /close que acontecer daqui em diante deixa uma
+        # lápide mais nova, e _mark_senders_open não re-marca esse sender.
+        batch_start = time.monotonic()
+        db = None
+        try:
+            db = get_db() # conexão própria da thread gravadora (thread-local)
+            cursor = db.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.executemany(_SQL_UPSERT_OPEN, rows)
+            new_or_reopened = cursor.rowcount
+            db.commit()
+            _invalidate_counters_cache()
+            # Todo sender do lote acabou de ficar (ou já estava) aberto.
+            _mark_senders_open((row[0] for row in rows), batch_start)
+            # Lote persistido: agora sim as entregas contam como processadas.
+            # Se o flush falhar, nada é registrado e o retry da Meta regrava.
+            for item in batch:
+                if item[1] is not None:
+                    _record_delivery(item[1])
+            logging.debug("Flush do gravador: %d msgs, %d conversas novas/reabertas.", len(rows), new_or_reopened)
+        except sqlite3.Error as e:
+            logging.error(f"Erro de DB no gravador assíncrono: {e}")
+            if db:
+                try:
+                    db.rollback()
+                except sqlite3.Error:
+                    pass
+        except Exception:
+            logging.exception("Erro inesperado no gravador assíncrono:")
+
+def _enqueue_rows(rows, signature_hash=None):
+    """Enfileira as tuplas para o gravador; descarta (com log) se a fila encher.
+
+    A assinatura da entrega pega carona na ÚLTIMA tupla enfileirada (e só se
+    nada foi descartado): o gravador a registra no dedupe depois do commit do
+    lote que a contém, então entrega com perda nunca é marcada como feita.
+    Retorna o número de tuplas descartadas.
+    """
+    dropped = 0
+    pending = None
+    for row in rows:
+        # Rajada do mesmo sender com a conversa já aberta: nada a gravar.
+        if _sender_known_open(row[0]):
+            continue
+        if pending is not None:
+            try:
+                _write_queue.put_nowait((pending, None))
+            except queue.Full:
+                dropped += 1
+        pending = row
+    if pending is not None:
+        try:
+            _write_queue.put_nowait((pending, signature_hash if dropped == 0 else None))
+        except queue.Full:
+            dropped += 1
+    if dropped:
+        logging.warning("Fila do gravador cheia: %d mensagens descartadas (a Meta reenvia).", dropped)
+    return dropped
+
+_writer_thread = threading.Thread(target=_writer_loop, name='db-writer', daemon=True)
+_writer_thread.start()
+
+def _iter_messages(data):
+    """Gera as tuplas (sender_id, timestamp, contact_name) do payload da Meta.
+
+    Generator em vez de lista: as tuplas vão direto do parse para a fila do
+    gravador, sem materializar uma coleção intermediária por request.
+    """
+    now = int(time.time())
+    for entry in data.get('entry', []):
+        for change in entry.get('changes', []):
+            value = change.get('value', {}) # value contém 'contacts' e 'messages'
+            # Assume que o primeiro contato é o remetente das mensagens
+            contacts = value.get('contacts', [])
+            contact_name = contacts[0].get('profile', {}).get('name') if contacts else None
+            for message in value.get('messages', []):
+                if 'from' in message and message.get('type'):
+                    # timestamp vem como string numérica; qualquer coisa
+                    # fora disso cai para o relógio do lote.
+                    try:
+                        ts = int(message.get('timestamp', now))
+                    except (TypeError, ValueError):
+                        ts = now
+                    yield (message['from'], ts, contact_name)
+
 # --- Endpoint do Webhook ---
 
 @app.route('/webhook', methods=['GET', 'POST'])
@@ -103,117 +445,78 @@ def webhook():
         verify_token = request.args.get('hub.verify_token')
         challenge = request.args.get('hub.challenge')
         mode = request.args.get('hub.mode')
-        logging.info(f"Webhook GET - Mode: {mode}, Token Recebido: {'***' if verify_token else 'Nenhum'}, Challenge: {challenge}")
+        # Formatação lazy (%s): a mensagem só é montada se o nível aceitar.
+        logging.info("Webhook GET - Mode: %s, Token Recebido: %s, Challenge: %s", mode, '***' if verify_token else 'Nenhum', challenge)
         if mode == 'subscribe' and verify_token == VERIFY_TOKEN:
             logging.info("Webhook verificado com sucesso!")
             return Response(challenge, status=200)
         else:
-            logging.warning(f"Falha na verificação do webhook. Esperado: {VERIFY_TOKEN}, Recebido: {verify_token}")
+            logging.warning("Falha na verificação do webhook. Esperado: %s, Recebido: %s", VERIFY_TOKEN, verify_token)
             abort(403)
 
     elif request.method == 'POST':
-        # (Lógica de validação de assinatura POST inalterada)
+        # Rejeita corpos grandes pelo Content-Length antes de ler o stream
+        # (o MAX_CONTENT_LENGTH cobre o caso de header mentiroso).
+        if request.content_length and request.content_length > _MAX_BODY_BYTES:
+            abort(413)
+
+        # Validação de assinatura (pulada se APP_SECRET não estiver configurado)
         signature_header = request.headers.get('X-Hub-Signature-256', '')
-       # if not APP_SECRET: logging.error("APP_SECRET não configurado."); abort(500)
-        #if not signature_header.startswith('sha256='): logging.warning("Formato assinatura inválido."); abort(403)
-        #signature_hash = signature_header.split('=')[1]
-        #request_body = request.data
-        #try:
-        #    expected_hash = hmac.new(APP_SECRET.encode('utf-8'), request_body, hashlib.sha256).hexdigest()
-        #except Exception as e: logging.error(f"Erro HMAC: {e}"); abort(500)
-        #if not hmac.compare_digest(signature_hash, expected_hash): logging.warning("Assinatura inválida."); abort(403)
-        #logging.info("Assinatura verificada.")
-
-        # Processar Payload
-        data = request.get_json()
-        db = None
+        request_body = request.get_data(cache=True)
+        signature_hash = None
+        if APP_SECRET:
+            if not signature_header.startswith('sha256='):
+                logging.warning("Formato de assinatura inválido.")
+                abort(403)
+            signature_hash = signature_header.split('=', 1)[1]
+            if not _signature_valid(signature_hash, request_body):
+                logging.warning("Assinatura inválida.")
+                abort(403)
+            # Só consulta o dedupe: o registro acontece no gravador, depois
+            # que o lote da entrega foi de fato commitado.
+            if _is_duplicate_delivery(signature_hash):
+                logging.debug("Entrega duplicada (retry da Meta), respondendo 200 direto.")
+                return _json_response({'success': True})
+
+        # Processar Payload: reaproveita os bytes já lidos para o HMAC e
+        # decodifica com orjson, sem o re-parse nem o sniff de Content-Type
+        # do request.get_json() do Flask.
         try:
-            db = get_db()
-            cursor = db.cursor()
-
-            if data.get('object') == 'whatsapp_business_account':
-                for entry in data.get('entry', []):
-                    for change in entry.get('changes', []):
-                        value = change.get('value', {}) # value contém 'contacts' e 'messages'
-
-                        # --- EXTRAI O NOME DO CONTATO PRIMEIRO ---
-                        contact_name = None # Default
-                        sender_wa_id = None # Para comparação futura, se necessário
-                        contacts = value.get('contacts', [])
-                        if contacts:
-                            # Assume que o primeiro contato é o remetente da mensagem
-                            # Idealmente, você compararia contacts[0]['wa_id'] com message['from']
-                            profile = contacts[0].get('profile', {})
-                            contact_name = profile.get('name')
-                            sender_wa_id = contacts[0].get('wa_id')
-                            logging.info(f"Contato encontrado: ID={sender_wa_id}, Nome={contact_name}")
-
-
-                        # Processa as mensagens associadas a esses contatos/metadados
-                        if 'messages' in value:
-                            for message in value.get('messages', []):
-                                if 'from' in message and message.get('type'):
-                                    sender_id = message['from']
-
-                                    # Validação opcional (se wa_id foi extraído):
-                                    if sender_wa_id and sender_id != sender_wa_id:
-                                        logging.warning(f"ID do remetente da mensagem ({sender_id}) não corresponde ao ID do contato ({sender_wa_id}). Usando nome '{contact_name}' mesmo assim.")
-                                        # Você pode decidir não usar o nome se os IDs não baterem
-
-                                    timestamp = int(message.get('timestamp', int(time.time())))
-                                    logging.info(f"Msg recebida: {sender_id} ({contact_name or 'Sem nome'}) @ {timestamp}")
-
-                                    # --- LÓGICA DB ---
-                                    cursor.execute("SELECT status FROM conversations WHERE sender_id = ?", (sender_id,))
-                                    result = cursor.fetchone()
-
-                                    is_new_or_reopened = False
-                                    if result is None:
-                                        is_new_or_reopened = True
-                                        logging.info(f"Primeira msg de {sender_id}.")
-                                    elif result['status'] == 'closed':
-                                        is_new_or_reopened = True
-                                        logging.info(f"Reabrindo conversa com {sender_id}.")
-
-                                    if is_new_or_reopened:
-                                        # Atualiza contadores
-                                        cursor.execute("UPDATE counters SET value = value + 1 WHERE counter_name = 'new_conversation_count'")
-                                        cursor.execute("UPDATE counters SET value = value + 1 WHERE counter_name = 'open_conversation_count'")
-                                        if result and result['status'] == 'closed': # Se estava fechada, decrementa fechadas
-                                             cursor.execute("UPDATE counters SET value = value - 1 WHERE counter_name = 'closed_conversation_count'")
-
-
-                                        # --- ALTERAÇÃO NO INSERT/REPLACE: Adiciona contact_name ---
-                                        cursor.execute('''
-                                            INSERT OR REPLACE INTO conversations
-                                            (sender_id, status, creation_timestamp, closed_timestamp, contact_name)
-                                            VALUES (?, 'open', ?, NULL, ?)
-                                        ''', (sender_id, timestamp, contact_name)) # Passa o nome extraído
-                                        db.commit()
-                                        logging.info(f"Conversa com {sender_id} ({contact_name}) marcada/atualizada como ABERTA (creation: {timestamp}).")
-
-                                        # Log contadores
-                                        cursor.execute("SELECT value FROM counters WHERE counter_name = 'new_conversation_count'")
-                                        count_result = cursor.fetchone(); current_count = count_result['value'] if count_result else 'ERRO'
-                                        logging.info(f"CONTADOR NOVAS CONVERSAS: {current_count}")
-
-                                    else:
-                                        # Conversa já estava aberta.
-                                        # Opcional: Atualizar o nome se ele mudou?
-                                        # cursor.execute("UPDATE conversations SET contact_name = ? WHERE sender_id = ?", (contact_name, sender_id))
-                                        # db.commit()
-                                        logging.info(f"Msg recebida na conversa já aberta com {sender_id} ({contact_name}).")
-
-            return jsonify(success=True), 200
-
-        except sqlite3.Error as e:
-            logging.error(f"Erro DB no POST: {e}")
-            if db: db.rollback()
-            return jsonify(success=False, error="Database error"), 200
-        except Exception as e:
+            data = orjson.loads(request_body) if orjson is not None else json.loads(request_body)
+        except ValueError:
+            logging.warning("Payload JSON inválido no webhook.")
+            abort(400)
+        # JSON válido mas que não é um objeto no topo (ex.: uma lista):
+        # mesmo 400 das demais estruturas fora do formato.
+        if not isinstance(data, dict):
+            logging.warning("Payload do webhook com estrutura inesperada.")
+            abort(400)
+        # Payloads que não são do WhatsApp Business (pings, objetos
+        # desconhecidos) respondem 200 sem sequer tocar o banco.
+        if data.get('object') != 'whatsapp_business_account':
+            return _json_response({'success': True})
+
+        # ACK imediato: a extração flui do parse direto para a fila do
+        # gravador assíncrono (UPSERT em lote via executemany, um commit
+        # por flush). O 200 sai assim que o payload foi decodificado.
+        # Payloads sem mensagens relevantes (ex.: notificações de status
+        # de entrega) simplesmente não enfileiram nada.
+        try:
+            dropped = _enqueue_rows(_iter_messages(data), signature_hash)
+            if dropped:
+                # Descarte por fila cheia: a Meta só reenvia em não-200, e o
+                # dedupe (registrado só após o commit) não cobre esta entrega
+                # — responder 200 aqui tornaria a perda permanente.
+                return _json_response({'success': False, 'error': 'Write queue full'}, 503)
+            return _json_response({'success': True})
+        except (AttributeError, TypeError, ValueError):
+            # JSON válido mas com a estrutura errada (entry/changes/contacts
+            # que não são listas de objetos): mesmo tratamento do JSON inválido.
+            logging.warning("Payload do webhook com estrutura inesperada.")
+            abort(400)
+        except Exception:
             logging.exception("Erro inesperado no POST:")
-            if db: db.rollback()
-            return jsonify(success=False, error="Internal server error"), 200
+            return _json_response({'success': False, 'error': 'Internal server error'})
 
     else:
         abort(405)
@@ -222,113 +525,173 @@ def webhook():
 
 @app.route('/count', methods=['GET'])
 def get_count():
-    # (Lógica inalterada)
+    with _counters_cache_lock:
+        if _counters_cache['v'] is not None and time.monotonic() - _counters_cache['t'] < _COUNTERS_CACHE_TTL:
+            return _json_response(_counters_cache['v'])
     try:
         db = get_db()
         cursor = db.cursor()
-        counters = {}
-        for counter_name in ['new_conversation_count', 'open_conversation_count', 'closed_conversation_count']:
-            cursor.execute("SELECT value FROM counters WHERE counter_name = ?", (counter_name,))
-            result = cursor.fetchone()
-            counters[counter_name] = result['value'] if result else 0
-        logging.info(f"Retornando contagens: {counters}")
-        return jsonify(counters)
+        # Contadores derivados direto de conversations.status (uma agregação
+        # servida pelo índice). 'new' espelha 'open': /close sempre decrementava
+        # os dois juntos e /recalculate-counters já igualava ambos.
+        cursor.execute(_SQL_COUNT_BY_STATUS)
+        row = cursor.fetchone()
+        open_count = row['open_c'] or 0
+        counters = {
+            'new_conversation_count': open_count,
+            'open_conversation_count': open_count,
+            'closed_conversation_count': row['closed_c'] or 0,
+        }
+        with _counters_cache_lock:
+            _counters_cache['v'] = counters
+            _counters_cache['t'] = time.monotonic()
+        logging.debug("Retornando contagens: %s", counters)
+        return _json_response(counters)
     except sqlite3.Error as e:
         logging.error(f"Erro DB em /count: {e}")
-        return jsonify(error="Erro ao acessar banco de dados"), 500
+        return _json_response({'error': 'Erro ao acessar banco de dados'}, 500)
     except Exception as e:
         logging.exception("Erro inesperado em /count:")
-        return jsonify(error="Erro interno do servidor"), 500
+        return _json_response({'error': 'Erro interno do servidor'}, 500)
 
 
 @app.route('/status', methods=['GET'])
 def get_all_statuses():
-    """Retorna o status, timestamps e nome de todas as conversas."""
-    all_statuses = {}
+    """Retorna o status, timestamps e nome de todas as conversas.
+
+    O JSON é transmitido linha a linha direto do cursor: nada de montar o
+    dicionário intermediário com todas as conversas antes de serializar.
+    """
     try:
         db = get_db()
         cursor = db.cursor()
+        # Tuplas cruas neste cursor: pula a construção de um sqlite3.Row
+        # por linha; as chaves do dict vêm uma vez só de cursor.description.
+        cursor.row_factory = None
         # --- ALTERAÇÃO NO SELECT: Adiciona contact_name ---
-        cursor.execute("SELECT sender_id, status, creation_timestamp, closed_timestamp, contact_name FROM conversations ORDER BY creation_timestamp DESC")
-        results = cursor.fetchall()
-        for row in results:
-            all_statuses[row['sender_id']] = dict(row)
-        logging.info(f"Retornando {len(all_statuses)} status de conversas.")
-        return jsonify(all_statuses)
+        cursor.execute(_SQL_STATUS_LIST)
+        cols = tuple(d[0] for d in cursor.description)
     except sqlite3.Error as e:
         logging.error(f"Erro de DB em /status: {e}")
-        return jsonify(error="Erro ao acessar banco de dados"), 500
-    except Exception as e:
-        logging.exception("Erro inesperado em /status:")
-        return jsonify(error="Erro interno do servidor"), 500
+        return _json_response({'error': 'Erro ao acessar banco de dados'}, 500)
+
+    def generate():
+        yield b'{'
+        count = 0
+        for row in cursor:
+            fragment = _json_dumps(row[0]) + b':' + _json_dumps(dict(zip(cols, row)))
+            yield fragment if count == 0 else b',' + fragment
+            count += 1
+        yield b'}'
+        logging.debug("Retornados %d status de conversas.", count)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+@app.route('/export.csv', methods=['GET'])
+def export_conversations_csv():
+    """Exporta todas as conversas em CSV, transmitido em lotes de 1024 linhas.
+
+    Memória limitada a um lote por vez; o custo de escrita na resposta é
+    amortizado num writerows por lote em vez de uma linha por vez.
+    """
+    try:
+        db = get_db()
+        cursor = db.cursor()
+        cursor.execute(_SQL_STATUS_LIST)
+    except sqlite3.Error as e:
+        logging.error(f"Erro de DB em /export.csv: {e}")
+        return _json_response({'error': 'Erro ao acessar banco de dados'}, 500)
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(('sender_id', 'status', 'creation_timestamp', 'closed_timestamp', 'contact_name'))
+        yield buffer.getvalue()
+        while True:
+            batch = cursor.fetchmany(1024)
+            if not batch:
+                break
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(batch)
+            yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), mimetype='text/csv')
 
 
 @app.route('/close/<sender_id>', methods=['POST'])
 def close_conversation(sender_id):
     # (Lógica inalterada, não mexe com o nome ao fechar)
-    logging.info(f"Req para fechar conversa: {sender_id}")
+    logging.info("Req para fechar conversa: %s", sender_id)
     db = None
     try:
         db = get_db()
         cursor = db.cursor()
-        cursor.execute("SELECT status FROM conversations WHERE sender_id = ?", (sender_id,))
+        cursor.execute(_SQL_SELECT_STATUS, (sender_id,))
         result = cursor.fetchone()
 
         if result and result['status'] == 'open':
             closed_time = int(time.time())
-            cursor.execute("UPDATE conversations SET status = 'closed', closed_timestamp = ? WHERE sender_id = ?",
-                           (closed_time, sender_id))
-
-            cursor.execute("UPDATE counters SET value = value - 1 WHERE counter_name = 'open_conversation_count'")
-            cursor.execute("UPDATE counters SET value = value + 1 WHERE counter_name = 'closed_conversation_count'")
-            cursor.execute("UPDATE counters SET value = value - 1 WHERE counter_name = 'new_conversation_count'")
-
-            db.commit()
-            logging.info(f"Conversa com {sender_id} marcada como FECHADA @ {closed_time}.")
-            return jsonify(status="closed")
+            # Sem tabela de contadores não há mais nada para ajustar aqui:
+            # um único UPDATE (autocommit) fecha a conversa.
+            cursor.execute(_SQL_CLOSE_CONV, (closed_time, sender_id))
+            _invalidate_counters_cache()
+            _forget_sender(sender_id)
+            logging.info("Conversa com %s marcada como FECHADA @ %d.", sender_id, closed_time)
+            return _json_response({'status': 'closed'})
         elif result and result['status'] == 'closed':
-            logging.info(f"Conversa com {sender_id} já estava fechada.")
-            return jsonify(status="already_closed")
+            # Auto-correção: se o cache de abertos divergiu do banco (ex.:
+            # corrida perdida no passado), este é o ponto de ressincronizar.
+            _forget_sender(sender_id)
+            logging.info("Conversa com %s já estava fechada.", sender_id)
+            return _json_response({'status': 'already_closed'})
         else:
-            logging.warning(f"Conversa não encontrada para fechar: {sender_id}")
-            return jsonify(status="not_found"), 404
+            logging.warning("Conversa não encontrada para fechar: %s", sender_id)
+            return _json_response({'status': 'not_found'}, 404)
     except sqlite3.Error as e:
         logging.error(f"Erro de DB em /close/{sender_id}: {e}")
         if db: db.rollback()
-        return jsonify(error="Erro ao acessar banco de dados"), 500
+        return _json_response({'error': 'Erro ao acessar banco de dados'}, 500)
     except Exception as e:
         logging.exception(f"Erro inesperado em /close/{sender_id}:")
         if db: db.rollback()
-        return jsonify(error="Erro interno do servidor"), 500
+        return _json_response({'error': 'Erro interno do servidor'}, 500)
 
 
 @app.route('/recalculate-counters', methods=['POST'])
 def recalculate_counters():
-    # (Lógica inalterada)
+    # Mantido por compatibilidade com o cliente C#: os contadores agora são
+    # sempre derivados de conversations.status, então "recalcular" é só ler
+    # a agregação e derrubar o cache.
+    db = None # Definido antes do try: se get_db() falhar, o except não estoura NameError
     try:
         db = get_db()
         cursor = db.cursor()
-        cursor.execute("SELECT COUNT(*) as count FROM conversations WHERE status = 'open'")
-        open_count = cursor.fetchone()['count']
-        cursor.execute("SELECT COUNT(*) as count FROM conversations WHERE status = 'closed'")
-        closed_count = cursor.fetchone()['count']
-        cursor.execute("UPDATE counters SET value = ? WHERE counter_name = ?", (open_count, 'open_conversation_count'))
-        cursor.execute("UPDATE counters SET value = ? WHERE counter_name = ?", (closed_count, 'closed_conversation_count'))
-        cursor.execute("UPDATE counters SET value = ? WHERE counter_name = ?", (open_count, 'new_conversation_count'))
-        db.commit()
+        cursor.execute(_SQL_COUNT_BY_STATUS)
+        row = cursor.fetchone()
+        open_count = row['open_c'] or 0
+        closed_count = row['closed_c'] or 0
+        _invalidate_counters_cache()
         logging.info("Contadores recalculados.")
-        return jsonify({ "success": True, "open_conversation_count": open_count, "closed_conversation_count": closed_count, "new_conversation_count": open_count })
+        return _json_response({ "success": True, "open_conversation_count": open_count, "closed_conversation_count": closed_count, "new_conversation_count": open_count })
     except sqlite3.Error as e:
         logging.error(f"Erro de DB em /recalculate-counters: {e}")
-        if db: db.rollback(); return jsonify(error="Erro ao acessar banco de dados"), 500
+        if db: db.rollback()
+        return _json_response({'error': 'Erro ao acessar banco de dados'}, 500)
     except Exception as e:
         logging.exception("Erro inesperado em /recalculate-counters:")
-        if db: db.rollback(); return jsonify(error="Erro interno do servidor"), 500
+        if db: db.rollback()
+        return _json_response({'error': 'Erro interno do servidor'}, 500)
 
 # --- Inicialização ---
 if __name__ == '__main__':
     init_db()
     port = int(os.environ.get("PORT", 5000))
-    logging.info(f"Iniciando Flask app na porta {port}...")
-    serve(app, host='0.0.0.0', port=port, threads=4)
+    # Com as conexões por thread, o throughput escala com o número de
+    # threads até bater no lock de escrita do SQLite (WAL mantém leituras
+    # concorrentes); o valor fica configurável pelo ambiente.
+    threads = int(os.environ.get("WEB_CONCURRENCY", 4))
+    logging.info(f"Iniciando Flask app na porta {port} com {threads} threads...")
+    serve(app, host='0.0.0.0', port=port, threads=threads)
 